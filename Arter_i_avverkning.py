@@ -1,6 +1,20 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.fs as pafs
+import shapely
+from openpyxl import load_workbook
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from itertools import repeat
+import json
+import os
+import shutil
 import sys
 
 def get_config():
@@ -20,29 +34,248 @@ def get_config():
     return {
         "input_dir": indata_dir,
         "map_dir": indata_dir,
-        "cache_obs": processed_dir / "Art_cache.parquet",
+        "cache_obs": processed_dir / "Art_cache.arrow",
+        # "mtime": artcachen läses om när någon Excel-fil är nyare, "exists": använd cachen om den finns
+        "cache_mode": "mtime",
         "cache_layers": {
-            "utford": processed_dir / "utford_cache.parquet",
-            "anmald": processed_dir / "anmald_cache.parquet"
+            "utford": processed_dir / "utford_cache",
+            "anmald": processed_dir / "anmald_cache"
         },
         "output_file": processed_dir / "Art_analys_resultat.xlsx",
         "layers": {
             "utford": "sksUtfordAvverk.gpkg",
             "anmald": "sksAvverkAnm.gpkg"
         },
+        "layer_cols": {
+            "utford": ['Beteckn', 'Avvdatum'],
+            "anmald": ['Beteckn', 'Inkomdatum']
+        },
         "keep_cols": [
             'Rödlistade', 'Artnamn', 'Vetenskapligt namn', 'Antal', 'Enhet', 
             'Huvudlokal', 'Lokalnamn', 'Ost', 'Nord', 'Noggrannhet', 
             'Diffusion', 'Startdatum', 'Starttid', 'Publik kommentar', 
             'Rapportör', 'Observatörer', 'Län'
         ],
+        "category_cols": [
+            'Artnamn', 'Enhet', 'Län', 'Rödlistade', 'Noggrannhet', 'Källa'
+        ],
         "crs": "EPSG:3006"
     }
 
 
+# Partitionskolumn (år) för lagercachen
+YEAR_COL = 'Avvår'
+
+
+def _source_names(sources):
+    """
+    Ger de sorterade filnamnen för de källfiler som finns.
+    
+    Args:
+        sources (list): Filer (Path) som en cache bygger på.
+        
+    Returns:
+        list: Sorterade filnamn.
+    """
+    return sorted(f.name for f in sources if f.exists())
+
+
+def _write_cache(gdf, path, date_col=None, sources=None):
+    """
+    Sparar en GeoDataFrame som Arrow IPC (Feather v2) med GeoArrow-kodad geometri.
+    
+    Args:
+        gdf (gpd.GeoDataFrame): Data som ska cachas.
+        path (Path): Sökväg till cache-filen.
+        date_col (str, optional): Datumkolumn. Om den anges sparas cachen som en
+            mapp partitionerad per år, så att äldre år kan hoppas över vid läsning.
+        sources (list, optional): Källfiler vars namn sparas i schemat, så att
+            tillagda eller borttagna filer upptäcks av _cache_is_fresh.
+    """
+    # Skriv till en temporär sökväg och byt namn, så att en avbruten körning aldrig lämnar en halv cache
+    tmp = path.with_suffix(".tmp")
+    if tmp.is_dir():
+        shutil.rmtree(tmp)
+    elif tmp.exists():
+        tmp.unlink()
+    
+    # Okomprimerat så att filen kan minnesmappas utan avkodning vid läsning
+    # (GeoArrow kräver minst en geometri, en tom tabell sparas med WKB)
+    encoding = "WKB" if gdf.empty else "geoarrow"
+    table = pa.table(gdf.to_arrow(index=True, geometry_encoding=encoding))
+    if sources is not None:
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'sources'] = json.dumps(_source_names(sources)).encode()
+        table = table.replace_schema_metadata(metadata)
+    if date_col is None or date_col not in gdf.columns or gdf.empty:
+        # En tom tabell ger inga partitioner, den sparas som en fil så att schemat finns kvar
+        feather.write_feather(table, tmp, compression="uncompressed")
+    else:
+        table = table.append_column(YEAR_COL, pa.array(gdf[date_col].dt.year.to_numpy()))
+        ds.write_dataset(
+            table, tmp, format="ipc", partitioning=[YEAR_COL], partitioning_flavor="hive",
+            existing_data_behavior="delete_matching"
+        )
+    
+    # os.replace byter atomiskt fil mot fil, en gammal cache av annan sort tas bort först
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists() and tmp.is_dir():
+        path.unlink()
+    os.replace(tmp, path)
+
+
+def _open_cache_dataset(path):
+    """
+    Öppnar en cache som minnesmappat pyarrow-dataset.
+    
+    Args:
+        path (Path): Sökväg till cache-filen eller den årspartitionerade mappen.
+        
+    Returns:
+        ds.Dataset: Dataset över cachens filer.
+    """
+    return ds.dataset(
+        str(path), format="ipc", partitioning="hive",
+        filesystem=pafs.LocalFileSystem(use_mmap=True)
+    )
+
+
+def _read_cache(path, columns=None, min_year=None):
+    """
+    Läser en cache skriven av _write_cache via minnesmappning.
+    
+    Args:
+        path (Path): Sökväg till cache-filen eller den årspartitionerade mappen.
+        columns (list, optional): Attributkolumner att läsa (geometri och index följer alltid med).
+        min_year (int, optional): Läs bara år >= min_year (endast partitionerad cache).
+        
+    Returns:
+        gpd.GeoDataFrame: Cachad data med koordinatsystem och index.
+    """
+    dataset = _open_cache_dataset(path)
+    names = dataset.schema.names
+    partitioned = YEAR_COL in names
+    
+    if columns is not None:
+        # Kolumner som väljs bort avkodas aldrig från den minnesmappade filen
+        keep = set(columns) | {'geometry'}
+        keep |= {c for c in dataset.schema.pandas_metadata['index_columns'] if isinstance(c, str)}
+        names = [c for c in names if c in keep]
+    else:
+        names = [c for c in names if c != YEAR_COL]
+    
+    # Hela årsmappar utanför tidsspannet läses aldrig
+    year_filter = pc.field(YEAR_COL) >= min_year if partitioned and min_year is not None else None
+    gdf = gpd.GeoDataFrame.from_arrow(dataset.to_table(columns=names, filter=year_filter))
+    
+    # Partitionerna läses årsvis, återställ ursprunglig radordning
+    return gdf.sort_index() if partitioned else gdf
+
+
+def _hilbert_order(geoms):
+    """
+    Ger positionerna för geometrierna sorterade längs en Hilbertkurva.
+    
+    Args:
+        geoms (gpd.GeoSeries): Geometrier att sortera.
+        
+    Returns:
+        np.ndarray: Positioner i rumslig ordning (närliggande geometrier intill varandra).
+    """
+    if geoms.empty:
+        return np.arange(0)
+    return np.argsort(geoms.hilbert_distance().to_numpy(), kind='stable')
+
+
+def _load_one(path, keep_cols):
+    """
+    Läser in och tvättar en enskild Excel-fil från Artportalen.
+
+    Args:
+        path (Path): Sökväg till Excel-filen.
+        keep_cols (list): Kolumner som ska behållas (om de finns i filen).
+
+    Returns:
+        pd.DataFrame: Tvättad artdata med kolumnen 'Källa' satt till filnamnet.
+    """
+    # Strömmande läsning (read_only) utan cellobjekt och formatering
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        # Hoppa över de två första raderna (skiprows=2), tredje raden är rubriker
+        next(rows, None); next(rows, None)
+        header = list(next(rows, ()))
+
+        # Behåll endast kolumnerna från config (om de finns i filen)
+        valid_cols = [c for c in keep_cols if c in header]
+        keep_idx = [header.index(c) for c in valid_cols]
+        records = [
+            tuple(row[i] if i < len(row) else None for i in keep_idx)
+            for row in rows
+        ]
+    finally:
+        wb.close()
+    df = pd.DataFrame.from_records(records, columns=valid_cols)
+
+    # Alla kolumnändringar görs på den nya ramen och raderna filtreras en gång
+    # på slutet, så att ingen mellankopia skapas eller skrivs till.
+    # Fixa datatyper för att undvika ArrowInvalid-krasch
+    df['Ost'] = pd.to_numeric(df['Ost'], errors='coerce')
+    df['Nord'] = pd.to_numeric(df['Nord'], errors='coerce')
+    df['Källa'] = path.name
+
+    if 'Antal' in df.columns:
+        # Gör om 'noterad' till NaN så kolumnen blir rent numerisk
+        df['Antal'] = pd.to_numeric(df['Antal'], errors='coerce')
+
+    # Rensa bort rader som saknar koordinater
+    keep = df['Ost'].notna() & df['Nord'].notna()
+
+    if 'Noggrannhet' in df.columns:
+        # Tvinga till siffra (om det finns text där)
+        df['Noggrannhet'] = pd.to_numeric(df['Noggrannhet'], errors='coerce')
+        # Behåll endast rader med noggrannhet <= 50 (och de som saknar värde helt om du vill)
+        keep &= df['Noggrannhet'] <= 50
+
+    return df[keep]
+
+
+def _cache_is_fresh(cfg, path, sources, columns=None):
+    """
+    Avgör om en befintlig cache kan användas.
+    
+    Args:
+        cfg (dict): Konfigurations-dictionary (styr via 'cache_mode').
+        path (Path): Sökväg till cache-filen eller cache-mappen.
+        sources (list): Filer som cachen bygger på.
+        columns (list, optional): Kolumner som cachen måste innehålla.
+        
+    Returns:
+        bool: True om cachen finns, har alla kolumner och (i läget 'mtime')
+              är minst lika ny som alla källor.
+    """
+    if not path.exists():
+        return False
+    schema = _open_cache_dataset(path).schema
+    # En cache byggd med färre kolumner (t.ex. innan layer_cols utökades) byggs om i båda lägena
+    if columns is not None and set(columns) - set(schema.names):
+        return False
+    sources = [f for f in sources if f.exists()]
+    if cfg["cache_mode"] == "exists" or not sources:
+        return True
+    
+    # Tillagda eller borttagna källfiler syns inte alltid på ändringstiden
+    # (en kopierad äldre export behåller sin mtime), så filnamnen jämförs också
+    recorded = (schema.metadata or {}).get(b'sources')
+    if recorded is None or json.loads(recorded) != _source_names(sources):
+        return False
+    return path.stat().st_mtime_ns >= max(f.stat().st_mtime_ns for f in sources)
+
+
 def load_observations(cfg):
     """
-    Läser in och tvättar artdata från Excel eller Parquet-cache.
+    Läser in och tvättar artdata från Excel eller Arrow-cache.
     
     Args:
         cfg (dict): Konfigurations-dictionary från get_config().
@@ -51,58 +284,56 @@ def load_observations(cfg):
         gpd.GeoDataFrame: En GeoDataFrame med punktgeometri (SWEREF99 TM) 
                           innehållande tvättad artdata.
     """
+    cache_obs = cfg["cache_obs"]
+    obs_files = list(cfg["input_dir"].glob("*.xlsx"))
 
-    if cfg["cache_obs"].exists():
-        print(f"[Cache] Laddar observationer från {cfg['cache_obs'].name}...")
-        return gpd.read_parquet(cfg["cache_obs"])
+    # Cachen gäller om den är minst lika ny som alla Excel-filer
+    if _cache_is_fresh(cfg, cache_obs, obs_files):
+        print(f"[Cache] Laddar observationer från {cache_obs.name}...")
+        return _read_cache(cache_obs)
+    if cache_obs.exists():
+        print(f"[Cache] {cache_obs.name} matchar inte Excel-filerna, läser om...")
 
     print(f"[Inläsning] Läser Excel-filer från {cfg['input_dir']}...")
-    obs_files = list(cfg["input_dir"].glob("*.xlsx"))
     if not obs_files:
         print("[Fel] Inga filer hittades."); sys.exit()
 
-    dfs = []
     for f in obs_files:
         print(f" -> läser {f.name}")
-        df = pd.read_excel(f, skiprows=2)
-        
-        # Behåll endast kolumnerna från config (om de finns i filen)
-        valid_cols = [c for c in cfg["keep_cols"] if c in df.columns]
-        df = df[valid_cols].copy()
-        
-        # Fixa datatyper för att undvika ArrowInvalid-krasch
-        df['Ost'] = pd.to_numeric(df['Ost'], errors='coerce')
-        df['Nord'] = pd.to_numeric(df['Nord'], errors='coerce')
 
-        if 'Noggrannhet' in df.columns:
-            # Tvinga till siffra (om det finns text där)
-            df['Noggrannhet'] = pd.to_numeric(df['Noggrannhet'], errors='coerce')
-            # Behåll endast rader med noggrannhet <= 50 (och de som saknar värde helt om du vill)
-            df = df[df['Noggrannhet'] <= 50]
-        
-        if 'Antal' in df.columns:
-            # Gör om 'noterad' till NaN så kolumnen blir rent numerisk
-            df['Antal'] = pd.to_numeric(df['Antal'], errors='coerce')
-        
-        # Rensa bort rader som saknar koordinater
-        df = df.dropna(subset=['Ost', 'Nord'])
-        df['Källa'] = f.name
-        dfs.append(df)
+    # En process per fil när det finns flera (Excel-tolkning är CPU-bunden)
+    if len(obs_files) > 1:
+        with ProcessPoolExecutor() as ex:
+            dfs = list(ex.map(_load_one, obs_files, repeat(cfg["keep_cols"])))
+    else:
+        dfs = [_load_one(obs_files[0], cfg["keep_cols"])]
     
     combined_df = pd.concat(dfs, ignore_index=True)
+    
+    # Datum tolkas en gång här och sparas typat i cachen
+    combined_df['Startdatum'] = pd.to_datetime(combined_df['Startdatum'], errors='coerce')
 
+    # Få unika värden lagras som kategorier, övrig text som Arrow-strängar utan 'nan'
     for col in combined_df.columns:
-        if combined_df[col].dtype == 'object' and col != 'geometry':
-            combined_df[col] = combined_df[col].astype(str).replace('nan', '')
+        if col in cfg["category_cols"]:
+            combined_df[col] = combined_df[col].astype('category')
+        elif pd.api.types.is_string_dtype(combined_df[col].dtype):
+            combined_df[col] = combined_df[col].astype('string[pyarrow]').fillna('')
 
+    # Punkterna byggs direkt från numpy-arrayerna (Ost/Nord återanvänds i analysen)
+    xs = combined_df['Ost'].to_numpy(np.float64, copy=False)
+    ys = combined_df['Nord'].to_numpy(np.float64, copy=False)
     gdf_obs = gpd.GeoDataFrame(
         combined_df, 
-        geometry=gpd.points_from_xy(combined_df.Ost, combined_df.Nord), 
+        geometry=shapely.points(xs, ys), 
         crs=cfg["crs"]
     )
     
+    # Rumslig ordning ger bättre lokalitet i trädfrågorna, sparas så i cachen
+    gdf_obs = gdf_obs.iloc[_hilbert_order(gdf_obs.geometry)].reset_index(drop=True)
+    
     try:
-        gdf_obs.to_parquet(cfg["cache_obs"])
+        _write_cache(gdf_obs, cfg["cache_obs"], sources=obs_files)
         print(f" -> Cache skapad: {len(gdf_obs)} observationer.")
     except Exception as e:
         print(f"[Varning] Kunde inte spara cache (kör vidare ändå): {e}")
@@ -124,41 +355,90 @@ def load_filtered_logging(cfg, bbox, start_year):
     """
     logging_data = {}
     
+    # Lagercachen är klippt efter artfyndens BBOX och startår, så den är inaktuell
+    # om artcachen eller någon Excel-fil är nyare än den
+    obs_sources = [cfg["cache_obs"]] + list(cfg["input_dir"].glob("*.xlsx"))
+    
     for layer, filename in cfg["layers"].items(): # utförd och anmäld
         cache_path = cfg["cache_layers"][layer]
+        columns = cfg["layer_cols"][layer]
+        
+        date_col = 'Avvdatum' if layer == 'utford' else 'Inkomdatum'
         
-        # Om vi laddar från cache, har vi redan filtrerat (eller så filtrerar vi igen för säkerhets skull)
-        if cache_path.exists():
+        # Cachen är redan filtrerad och datumtypad, årsfiltret sker direkt i Arrow-läsningen
+        if _cache_is_fresh(cfg, cache_path, obs_sources, columns=columns):
             print(f"[Cache] Laddar {layer}...")
-            gdf = gpd.read_parquet(cache_path)
+            gdf = _read_cache(cache_path, columns=columns, min_year=start_year)
         else:
+            if cache_path.exists():
+                print(f"[Cache] {layer} är inaktuell (artdatan har ändrats eller kolumner saknas), läser om...")
             path = cfg["map_dir"] / filename
             print(f"[Inläsning] Filtrerar {filename} mot BBOX...")
-            gdf = gpd.read_file(path, bbox=bbox)
+            gdf = gpd.read_file(path, bbox=bbox, engine="pyogrio", columns=columns)
             if gdf.crs != cfg["crs"]:
                 gdf = gdf.to_crs(cfg["crs"])
 
-        date_col = 'Avvdatum' if layer == 'utford' else 'Inkomdatum'    # --- FILTRERING PÅ TID ---
-        
-        if date_col in gdf.columns:
-            before_count = len(gdf)
-            gdf[date_col] = pd.to_datetime(gdf[date_col], errors='coerce')
-            # Behåll endast avverkningar från och med samma år som första observationen
-            gdf = gdf[gdf[date_col].dt.year >= start_year]
-            
-            diff = before_count - len(gdf)
-            if diff > 0:
-                print(f" -> Tog bort {diff} st {layer} avverkningar från före år {start_year}")
+            # --- FILTRERING PÅ TID ---
+            if date_col in gdf.columns:
+                before_count = len(gdf)
+                gdf[date_col] = pd.to_datetime(gdf[date_col], errors='coerce')
+                # Behåll endast avverkningar från och med samma år som första observationen
+                gdf = gdf[gdf[date_col].dt.year >= start_year]
+                
+                diff = before_count - len(gdf)
+                if diff > 0:
+                    print(f" -> Tog bort {diff} st {layer} avverkningar från före år {start_year}")
 
-        # Spara till cache 
-        if not cache_path.exists():
-            gdf.to_parquet(cache_path)
+            # Spara till cache, partitionerad per år
+            _write_cache(gdf, cache_path, date_col=date_col, sources=obs_sources)
             
         logging_data[layer] = gdf
         
     return logging_data
 
 
+def _join_hits(gdf_obs, gdf_logging, pt_idx, poly_idx):
+    """
+    Bygger en träfftabell med artpunkterna och 'index_right' som i gpd.sjoin(how="inner").
+    
+    Avverkningens övriga kolumner följer inte med, de läggs till först när
+    resultatet sparas (se describe_and_save).
+    
+    Args:
+        gdf_obs (gpd.GeoDataFrame): GeoDataFrame med artpunkter.
+        gdf_logging (gpd.GeoDataFrame): GeoDataFrame med avverkningspolygoner.
+        pt_idx (np.ndarray): Positioner i gdf_obs för varje träff.
+        poly_idx (np.ndarray): Positioner i gdf_logging för varje träff.
+        
+    Returns:
+        gpd.GeoDataFrame: Artpunkterna med kolumnen 'index_right'.
+    """
+    # Samma radordning som sjoin: per punkt, därefter per polygon
+    order = np.lexsort((poly_idx, pt_idx))
+    pt_idx, poly_idx = pt_idx[order], poly_idx[order]
+    
+    hits = gdf_obs.iloc[pt_idx].copy()
+    hits['index_right'] = gdf_logging.index[poly_idx]
+    return hits
+
+
+def _first_hit_per_point(pt_idx, poly_idx):
+    """
+    Behåller endast den första polygonen (lägsta position) för varje punkt.
+    
+    Args:
+        pt_idx (np.ndarray): Positioner för punkterna i träffparen.
+        poly_idx (np.ndarray): Positioner för polygonerna i träffparen.
+        
+    Returns:
+        tuple: (pt_idx, poly_idx) med högst en träff per punkt.
+    """
+    order = np.lexsort((poly_idx, pt_idx))
+    pt_idx, poly_idx = pt_idx[order], poly_idx[order]
+    _, first = np.unique(pt_idx, return_index=True)
+    return pt_idx[first], poly_idx[first]
+
+
 def run_spatial_analysis(gdf_obs, logging_data):
     """
     Korsar artpunkter med avverkningspolygoner geografiskt.
@@ -173,31 +453,69 @@ def run_spatial_analysis(gdf_obs, logging_data):
     """
     results = {}
     
-    # Skapa en solid yta (gummiband) runt alla observationer
-    study_area_mask = gdf_obs.union_all().convex_hull.buffer(50)
+    # Koordinaterna som råa arrayer för gummibandet och punkt-i-polygon-testet
+    # (Ost/Nord är samma värden som punktgeometrin byggdes av)
+    xs = gdf_obs['Ost'].to_numpy(np.float64, copy=False)
+    ys = gdf_obs['Nord'].to_numpy(np.float64, copy=False)
     
-    # Skapa 50m buffert runt alla observationer för själva träff-analysen
-    gdf_obs_buffered = gdf_obs.copy()
-    gdf_obs_buffered['geometry'] = gdf_obs_buffered.geometry.buffer(50)
+    # Skapa en solid yta (gummiband) runt alla observationer,
+    # höljet räknas direkt på koordinaterna utan att först slå ihop punkterna
+    study_area_mask = shapely.multipoints(np.column_stack([xs, ys])).convex_hull.buffer(50)
+    shapely.prepare(study_area_mask)
     
     for key, gdf_logging in logging_data.items():
 
+        # Ett STRtree per lager som återanvänds för alla frågor nedan.
+        # Trädet byggs i Hilbertordning, träffarna översätts tillbaka till lagrets positioner via hilbert.
+        polygons = gdf_logging.geometry.values
+        hilbert = _hilbert_order(gdf_logging.geometry)
+        tree = shapely.STRtree(polygons[hilbert])
+
         # Behåll endast avverkningar som nuddar studieområdet
-        relevant_logging = gdf_logging[gdf_logging.intersects(study_area_mask)].copy()
+        # (STRtree sållar på bbox först, exakt test mot studieområdet bara för kandidaterna)
+        idx = np.sort(hilbert[tree.query(study_area_mask, predicate="intersects")])
+        relevant_logging = gdf_logging.iloc[idx].copy()
+        
+        # Förbered (indexera) de relevanta polygonerna en gång inför alla predikat nedan
+        shapely.prepare(polygons[idx])
         
         print(f"[Analys] Matchar mot {len(relevant_logging)} relevanta områden i {key}...")
         
+        # Alla träffar nedan ligger inom studieområdet, så positionerna i hela lagret kan användas direkt
         # 1. Direkt i (Status: Inuti)
-        in_zone = gpd.sjoin(gdf_obs, relevant_logging, how="inner", predicate="within")
-        in_zone['Status_Analys'] = 'Inuti'
+        # Kandidater via bbox i trädet, sedan exakt test per polygon på råa koordinater
+        cand_pt_idx, cand_poly_idx = tree.query(gdf_obs.geometry.values)
+        cand_poly_idx = hilbert[cand_poly_idx]
         
-        # 2. Inom 50m (Status: Nära)
-        all_near = gpd.sjoin(gdf_obs_buffered, relevant_logging, how="inner", predicate="intersects")
+        order = np.argsort(cand_poly_idx, kind='stable')
+        cand_pt_idx, cand_poly_idx = cand_pt_idx[order], cand_poly_idx[order]
+        poly_ids, starts = np.unique(cand_poly_idx, return_index=True)
+        ends = np.r_[starts[1:], len(cand_poly_idx)]
+        
+        inside = np.zeros(len(cand_pt_idx), dtype=bool)
+        for poly_id, start, end in zip(poly_ids, starts, ends):
+            cand = cand_pt_idx[start:end]
+            inside[start:end] = shapely.contains_xy(polygons[poly_id], xs[cand], ys[cand])
+        in_pt_idx, in_poly_idx = cand_pt_idx[inside], cand_poly_idx[inside]
+        
+        # 2. Inom 50m (Status: Nära), avståndsfråga direkt på punkterna utan buffertpolygoner.
+        # dwithin mäter exakt 50 m, en buffer(50) är en inskriven polygon och missar
+        # därför punkter strax under 50 m från ett polygonhörn.
+        near_pt_idx, near_poly_idx = tree.query(gdf_obs.geometry.values, predicate="dwithin", distance=50)
+        near_poly_idx = hilbert[near_poly_idx]
+        
+        # 3. Prioritera 'Inuti': närzonen behåller bara punkter som inte redan ligger inuti
+        near_only = ~np.isin(near_pt_idx, in_pt_idx)
+        near_pt_idx, near_poly_idx = near_pt_idx[near_only], near_poly_idx[near_only]
+        
+        # En träff per punkt (första polygonen) i varje status
+        in_zone = _join_hits(gdf_obs, gdf_logging, *_first_hit_per_point(in_pt_idx, in_poly_idx))
+        in_zone['Status_Analys'] = 'Inuti'
+        all_near = _join_hits(gdf_obs, gdf_logging, *_first_hit_per_point(near_pt_idx, near_poly_idx))
         all_near['Status_Analys'] = 'Nära (50m)'
         
-        # 3. Kombinera och prioritera 'Inuti'
         combined = pd.concat([in_zone, all_near])
-        combined = combined[~combined.index.duplicated(keep='first')]
+        combined['Status_Analys'] = pd.Categorical(combined['Status_Analys'], categories=['Inuti', 'Nära (50m)'])
         
         # Spara både träffarna OCH det filtrerade lagret för statistik
         results[key] = {
@@ -209,6 +527,33 @@ def run_spatial_analysis(gdf_obs, logging_data):
 
 
 
+def _write_sheet(writer, df, sheet_name):
+    """
+    Skriver en DataFrame till ett nytt Excel-blad, en rad i taget.
+    
+    I constant_memory-läge skriver xlsxwriter bara den aktuella raden till disk,
+    medan df.to_excel() skriver kolumnvis och då tappar värden.
+    
+    Args:
+        writer (pd.ExcelWriter): Öppen ExcelWriter med motorn xlsxwriter.
+        df (pd.DataFrame): Data utan geometrikolumn.
+        sheet_name (str): Bladets namn.
+    """
+    workbook = writer.book
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_fmt = workbook.add_format({'bold': True})
+    date_fmt = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    
+    formats = [date_fmt if pd.api.types.is_datetime64_any_dtype(df[c]) else None for c in df.columns]
+    worksheet.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+    
+    # Saknade värden blir tomma celler
+    values = df.astype(object).where(df.notna(), None)
+    for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        for c, value in enumerate(row):
+            worksheet.write(r, c, value, formats[c])
+
+
 def describe_and_save(gdf_obs, results, logging_data, cfg):
     """
     Sammanställer analysen i terminalen och sparar detaljer till Excel.
@@ -223,10 +568,10 @@ def describe_and_save(gdf_obs, results, logging_data, cfg):
         None: Funktionen skriver ut till terminalen och sparar en fil på hårddisken.
     """
     # 1. Arter
-    arter = ", ".join(gdf_obs['Artnamn'].unique())
+    arter = ", ".join(gdf_obs['Artnamn'].dropna().unique())
     
     # 2. Tidsperiod Observationer
-    obs_dates = pd.to_datetime(gdf_obs['Startdatum'], errors='coerce')
+    obs_dates = gdf_obs['Startdatum']
     obs_min, obs_max = int(obs_dates.min().year), int(obs_dates.max().year)
     
     # 3. Geografi - Län
@@ -254,18 +599,23 @@ def describe_and_save(gdf_obs, results, logging_data, cfg):
         date_col = 'Avvdatum' if key == 'utford' else 'Inkomdatum'
         date_info = ""
         if not layer_df.empty and date_col in layer_df.columns:
-            l_dates = pd.to_datetime(layer_df[date_col], errors='coerce').dropna()
+            l_dates = layer_df[date_col].dropna()
             date_info = f"{l_dates.min().year} till {l_dates.max().year}"
         else:
             date_info = "Saknas"
 
-        # Statistik
-        n_inuti = len(res_df[res_df['Status_Analys'] == 'Inuti'])
-        n_nara = len(res_df[res_df['Status_Analys'] == 'Nära (50m)'])
+        # Statistik, alla antal och områden per status i en enda gruppering
+        grp = res_df.groupby('Status_Analys', observed=True)
+        counts = grp.size()
+        area_sets = grp['index_right'].unique()
+        
+        n_inuti = counts.get('Inuti', 0)
+        n_nara = counts.get('Nära (50m)', 0)
         
-        all_affected_areas = res_df['index_right'].unique()
-        areas_inuti_ids = res_df[res_df['Status_Analys'] == 'Inuti']['index_right'].unique()
-        areas_nara_only = len(set(all_affected_areas) - set(areas_inuti_ids))
+        areas_inuti_ids = area_sets.get('Inuti', np.array([]))
+        areas_nara_ids = area_sets.get('Nära (50m)', np.array([]))
+        all_affected_areas = np.union1d(areas_inuti_ids, areas_nara_ids)
+        areas_nara_only = len(np.setdiff1d(areas_nara_ids, areas_inuti_ids))
         
         print(f"{layer_full_name} ({date_info}):")
         print(f"  VÄXTPLATSER :")
@@ -278,20 +628,24 @@ def describe_and_save(gdf_obs, results, logging_data, cfg):
         print(f"    - TOTALT berörda områden:                    {len(all_affected_areas)} st utav {total_relevant} ({andel_omraden:.1f}%)")
         print()
 
-    all_dfs = [results[k]['matches'] for k in results]
-    all_affected_idx = pd.concat(all_dfs).index.unique()
+    # Unika berörda punkter via mängdunion av index, utan att slå ihop träfftabellerna
+    all_affected_idx = reduce(pd.Index.union, (results[k]['matches'].index for k in results), pd.Index([]))
     
     print(f"TOTALT UNIKA VÄXTPLATSER SOM BERÖRS:             {len(all_affected_idx)} av {len(gdf_obs)}")
     print(f"ANDEL BERÖRDA VÄXTPLATSER:                       {(len(all_affected_idx)/len(gdf_obs))*100:.1f}%")
     print("="*70)
 
-    # Spara till Excel
-    with pd.ExcelWriter(cfg["output_file"]) as writer:
-        gdf_obs.drop(columns='geometry').to_excel(writer, sheet_name='Alla_Fynd', index=False)
+    # Spara till Excel, strömmat rad för rad till disk (constant_memory)
+    with pd.ExcelWriter(cfg["output_file"], engine="xlsxwriter",
+                        engine_kwargs={"options": {"constant_memory": True}}) as writer:
+        _write_sheet(writer, gdf_obs.drop(columns='geometry'), 'Alla_Fynd')
         for key, data in results.items():
             df = data['matches']
             if not df.empty:
-                df.drop(columns='geometry').to_excel(writer, sheet_name=f'Träffar_{key}', index=False)
+                # Avverkningens kolumner hämtas via index_right först här
+                attrs = pd.DataFrame(logging_data[key].drop(columns='geometry'))
+                df = df.drop(columns='geometry').join(attrs, on='index_right', lsuffix='_left', rsuffix='_right')
+                _write_sheet(writer, df, f'Träffar_{key}')
 
 
 
@@ -301,8 +655,7 @@ if __name__ == "__main__":
     gdf_obs = load_observations(cfg)  # Laddar artdata till geo_dataframe
     
         # Ladda bara de avverkningar som är aktuella, med startår och BBOX som filter
-    obs_dates = pd.to_datetime(gdf_obs['Startdatum'], errors='coerce')
-    start_year = int(obs_dates.min().year)
+    start_year = int(gdf_obs['Startdatum'].min().year)
     boundary = tuple(gdf_obs.total_bounds)   
     logging_data = load_filtered_logging(cfg, boundary, start_year)
     